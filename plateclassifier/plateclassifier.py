@@ -23,51 +23,50 @@ if __name__ == "__main__" and __package__ is None:
     
 from shared.amqp import ThreadedAmqp
 import shared.utils as utils
-from shared.obj_detector import ObjDetector
 
-import pprint
 import yaml
-import threading
-import sys
 import numpy as np
-import time
 import os
 import argparse as argparse
 import json
-import queue
-import uuid
 import logging
-import pickle
-import traceback
 import signal
-import json
 from pymongo import MongoClient
-from skimage.transform import resize
 import cv2
 
 
+try:
+        from yaml import CSafeLoader as YamlLoader
+except ImportError:
+        from yaml import SafeLoader as YamlLoader
+
+
 #create logger
 logger = logging.getLogger('plateclassifier.service')
-logger.setLevel(logging.DEBUG)
-# create file handler which logs even debug messages
-fh = logging.FileHandler('plateclassifier.service.log')
-fh.setLevel(logging.DEBUG)
-# create console handler with a higher log level
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-# create formatter and add it to the handlers
-formatter = logging.Formatter('[%(levelname)1.1s %(asctime)s] %(message)s',"%Y-%m-%d %H:%M:%S")
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
-# add the handlers to the logger
-logger.addHandler(fh)
-logger.addHandler(ch)
+
+
+def setup_logging():
+        logger.setLevel(logging.DEBUG)
+        # create file handler which logs even debug messages
+        fh = logging.FileHandler('plateclassifier.service.log')
+        fh.setLevel(logging.DEBUG)
+        # create console handler with a higher log level
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        # create formatter and add it to the handlers
+        formatter = logging.Formatter('[%(levelname)1.1s %(asctime)s] %(message)s',"%Y-%m-%d %H:%M:%S")
+        fh.setFormatter(formatter)
+        ch.setFormatter(formatter)
+        # add the handlers to the logger
+        logger.addHandler(fh)
+        logger.addHandler(ch)
 
 
 class PlateClassifier():
         pc_model, pc_classes, pc_graph, pc_sess = None,None,None,None
         _consumer = None
         _publisher = None
+        _mongo = None
         
         def __init__(self, args):
                 
@@ -99,19 +98,27 @@ class PlateClassifier():
  
                 logger.info("Init complete")
 
-        def classifyPlate(self, img):
+        def classifyPlates(self, imgs):
+
+                if len(imgs) == 0:
+                        return []
 
-                plate_img_with_black_bg = utils.overlayImageOnBlackCanvas(img)
-                plate_img_gs = utils.convertToGrayscaleForClassification(plate_img_with_black_bg)
-                plate_img_expanded = np.expand_dims(plate_img_gs, axis=0)
+                # all plates of an image go through the model as one batch
+                plate_imgs_gs = np.stack([
+                        utils.convertToGrayscaleForClassification(utils.overlayImageOnBlackCanvas(img))
+                        for img in imgs
+                ])
                 
                 with self.pc_graph.as_default():
                         with self.pc_sess.as_default():
-                                predictions = self.pc_model.predict(plate_img_expanded)
+                                predictions = self.pc_model.predict(plate_imgs_gs)
 
-                max_score_index = np.argmax(predictions[0])
+                max_score_indices = np.argmax(predictions, axis=1)
 
-                return self.pc_classes[max_score_index], float(predictions[0][max_score_index])
+                return [
+                        (self.pc_classes[max_score_index], float(predictions[i][max_score_index]))
+                        for i, max_score_index in enumerate(max_score_indices)
+                ]
 
         def cleanup(self):
                 if self._consumer is not None:
@@ -120,6 +127,9 @@ class PlateClassifier():
                 if self._publisher is not None:
                         self._publisher.stop()
 
+                if self._mongo is not None:
+                        self._mongo.close()
+
         def loop_forever(self):
                 self._consumer.start()
                 self._publisher.start()
@@ -127,13 +137,12 @@ class PlateClassifier():
 
         def getDbConnection(self):
                 
-                client = MongoClient(config['mongo']['uri'])
+                # shared across calls so connections stay pooled and warm
+                if self._mongo is None:
+                        # openlpr is created by mongo on first write, no need to enumerate databases
+                        self._mongo = MongoClient(config['mongo']['uri'], maxPoolSize=8, retryWrites=True, w=1, connect=False)
 
-                #open db
-                if not "openlpr" in client.database_names():
-                        logger.info("database openlpr does not exist, will be created after first document insert")
-                        
-                return client
+                return self._mongo
 
         def getDoc(self, docid):
 
@@ -144,27 +153,24 @@ class PlateClassifier():
 
                 col = db['lprevents']
                 document = col.find_one(query)
-
-                client.close()
                 
                 return document
                 
-        def updateDb(self, doc):
+        def updateDb(self, doc, fields):
 
                 client = self.getDbConnection()
 
                 db = client["openlpr"]
                 query = {"_id": doc['_id']}
-                updatedDoc = { "$set": doc}
+                # only $set what changed, the rest of the document is already stored
+                updatedDoc = { "$set": {field: doc[field] for field in fields}}
 
                 col = db['lprevents']
                 col.update_one(query, updatedDoc)
 
-                client.close()
-
 
         def newImageQueued(self, msg):
-                logger.debug(msg)
+                logger.debug("Received [%s]", msg)
 
                 try:
                         # load image
@@ -174,13 +180,14 @@ class PlateClassifier():
                         originalImage = utils.load_image_into_numpy_array(diskpath, None, False)
                         originalShape = originalImage.shape
                         
-                        logger.debug("Loaded image [{}]".format(diskpath))
+                        logger.debug("Loaded image [%s]", diskpath)
 
                         msg['classifications'] = []
                         document = msg
 
                         # slice
                         plate_images = []
+                        plate_crops = []
                         for i in range(0, len(document['detections']['boxes'])):
                                 if document['detections']['scores'][i] >= config['classification']['minScore']:
                                         plateImage = originalImage[
@@ -194,10 +201,16 @@ class PlateClassifier():
 
                                         filename = os.path.join(config['storage']['path'], filename)
 
-                                        cv2.imwrite(filename, cv2.cvtColor(plateImage.copy(), cv2.COLOR_RGB2BGR))
+                                        # cvtColor allocates its own output, the crop view needs no copy
+                                        cv2.imwrite(filename, cv2.cvtColor(plateImage, cv2.COLOR_RGB2BGR))
+
+                                        plate_crops.append(plateImage)
 
-                                        platetype, score  = self.classifyPlate(plateImage)
-                                        
+                        # classify
+                        predictions = iter(self.classifyPlates(plate_crops))
+                        for i in range(0, len(document['detections']['boxes'])):
+                                if document['detections']['scores'][i] >= config['classification']['minScore']:
+                                        platetype, score  = next(predictions)
                                 else:
                                         platetype, score  = 'not classified',0.0
 
@@ -208,13 +221,13 @@ class PlateClassifier():
                                                 'score': score
                                         }
                                 )
-                                logger.info("[{}] classified as [{}] with confidence [{}]".format(msg['_id'],platetype, score))
+                                logger.info("[%s] classified as [%s] with confidence [%s]", msg['_id'], platetype, score)
 
                         #todo fix later, possible bug, num plates inequal num classifications/detections
                         msg['plate_imgs'] = plate_images
                         
                         # save to db
-                        self.updateDb(msg)
+                        self.updateDb(msg, ['classifications', 'plate_imgs'])
 
                         # dispatch to mq
                         self._publisher.publish_message(msg)
@@ -246,17 +259,19 @@ if __name__ == '__main__':
 
         args = vars(ap.parse_args())
 
+        setup_logging()
+
         #handle ctrl-c
         signal.signal(signal.SIGINT, signal_handler)
 
         with open(args["config.file"]) as stream:
                 try:
                         if os.getenv('PRODUCTION') is not None: 
-                                config = yaml.load(stream)['prod']
+                                config = yaml.load(stream, Loader=YamlLoader)['prod']
                         else:
-                                config = yaml.load(stream)['dev']
+                                config = yaml.load(stream, Loader=YamlLoader)['dev']
 
-                        pprint.pprint(config)
+                        logger.debug("Loaded config [%s]", config)
 
                 except yaml.YAMLError as err:
                         logger.error("An error occurred: ", exc_info=True)